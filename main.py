@@ -1,14 +1,22 @@
 import datetime
+import functools
 import logging
 import os
+import queue
+import re
+from logging.handlers import QueueHandler, QueueListener
+from types import MappingProxyType
 from typing import Callable
 
 import emoji
+import uvloop
 from babel.dates import format_date
 from dotenv import load_dotenv
-from telegram import ReplyKeyboardRemove, Update, ReplyKeyboardMarkup
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove, Update
 from telegram.constants import ParseMode
-from telegram.ext import CommandHandler, MessageHandler, filters, ConversationHandler, CallbackContext, Application
+from telegram.ext import CommandHandler, MessageHandler, filters, ConversationHandler, CallbackContext, Application, \
+    CallbackQueryHandler
+from telegram.request import HTTPXRequest
 
 load_dotenv()
 
@@ -18,21 +26,29 @@ HEROKU_PATH = os.getenv('HEROKU_PATH')
 TOKEN = os.getenv('TOKEN')
 LOCALE = os.getenv('LOCALE')
 CHANNEL_LINK = os.getenv('CHANNEL_LINK')
-
-# Enable logging
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-                    level=logging.INFO)
+MODERATION_CHAT_ID = int(os.getenv('MODERATION_CHAT_ID', 0))
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'WARNING')
+
+# Enable logging, routed through a queue so handlers only enqueue records and a
+# background thread does the formatting and writing
+_log_queue = queue.SimpleQueue()
+_log_output = logging.StreamHandler()
+_log_output.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+logging.getLogger().setLevel(LOG_LEVEL)
+logging.getLogger().addHandler(QueueHandler(_log_queue))
+_log_listener = QueueListener(_log_queue, _log_output)
+_log_listener.start()
 
 logger = logging.getLogger(__name__)
 
 # Constants
 
-ACCEPTED_CHARACTERS = ['.', ',', ':', ';', '!', '?', '(', ')', '[', ']', '{', '}', '/', '\\', '-', '_', '+', '=', '*', '@', '#', '$', '%', '^', '&', '|', '<', '>', '~', '`', '"', "'", '·', '’']
+ACCEPTED_CHARACTERS = frozenset(['.', ',', ':', ';', '!', '?', '(', ')', '[', ']', '{', '}', '/', '\\', '-', '_', '+', '=', '*', '@', '#', '$', '%', '^', '&', '|', '<', '>', '~', '`', '"', "'", '·', '’'])
 
 POST, TITLE, EMOJI, DATE, DESCRIPTION, LINK, CONTACT, CONFIRMATION = ['post', 'title', 'emoji', 'date', 'description',
                                                                       'link', 'contact', 'confirmation']
 
-fields_and_questions = {
+fields_and_questions = MappingProxyType({
     POST: 'Please read carefully the rules of posting with /rules before sending your post as any post that does not '
           'comply with these rules will not be posted!',
     TITLE: 'What is the title of the post?',
@@ -42,58 +58,71 @@ fields_and_questions = {
     LINK: 'What is the link of the post?',
     CONTACT: 'What is the contact of the post?',
     CONFIRMATION: '⬆️ Do you confirm this post? ⬆️',
-}
+})
 
-LIMITS = {
+LIMITS = MappingProxyType({
     TITLE: 10,
     EMOJI: 1,
     DESCRIPTION: 100,
     LINK: 100,
     CONTACT: 50,
-}
+})
 
-SPECIFIC_FORMATTING_INSTRUCTIONS = {
+SPECIFIC_FORMATTING_INSTRUCTIONS = MappingProxyType({
     TITLE: 'No emoji nor special characters',
     DATE: 'DD/MM or DD/MM-DD/MM',
-}
+})
 
-flow = [POST, TITLE, EMOJI, DATE, DESCRIPTION, LINK, CONTACT, CONFIRMATION]
+flow = (POST, TITLE, EMOJI, DATE, DESCRIPTION, LINK, CONTACT, CONFIRMATION)
+NEXT_FIELD = {flow[i]: flow[i + 1] for i in range(len(flow) - 1)}
 
 CONFIRM = '✅'
 DENY = '❌'
 
+# Markup objects are immutable, so share one instance instead of rebuilding them per message
+CONFIRM_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton(CONFIRM, callback_data=CONFIRM),
+                                          InlineKeyboardButton(DENY, callback_data=DENY)]])
+REMOVE_KEYBOARD = ReplyKeyboardRemove()
+
+# Filter matching plain text messages, shared by all conversation states
+TEXT_MESSAGE = filters.TEXT & ~filters.COMMAND
+
 suffix = 'Send /post to start again!'
 CONFIRM_SENT = 'Your post request has been sent to the moderatos! ' + suffix
 CANCEL_SENT = 'Your post request has been cancelled! ' + suffix
 
+POST_TEMPLATE = ("<b>{title}</b> {emoji}\n"
+                 "<i>{date}</i>\n"
+                 "\n"
+                 "{description}\n"
+                 "\n"
+                 "<a href='{link}'>Lien d'inscription</a>\n"
+                 "\n"
+                 "Contact : {contact}\n")
 
-# Helper functions
 
-async def build_post(update: Update, context: CallbackContext) -> str:
-    """Builds the post to be sent to the channel"""
-    user_data = context.user_data
-    text = ""
-    text += f"<b>{user_data[TITLE]}</b> {user_data[EMOJI]}\n"
-    text += f"<i>{' - '.join([format_date(datetime.datetime.strptime(d, '%d/%m'), format='dd MMMM', locale=LOCALE) for d in user_data[DATE].split('-')])}</i>\n"
-    text += f"\n"
-    text += f"{user_data[DESCRIPTION]}\n"
-    text += f"\n"
-    text += f"<a href='{user_data[LINK]}'>Lien d'inscription</a>\n"
-    text += f"\n"
-    text += f"Contact : {user_data[CONTACT]}\n"
+# Helper functions
 
-    return text
+@functools.lru_cache(maxsize=256)
+def _format_day_month(day: datetime.date) -> str:
+    """Formats a single date for display, caching the Babel locale lookup."""
+    return format_date(day, format='dd MMMM', locale=LOCALE)
 
 
-def and_(predicates: list[Callable[[str], bool]]) -> Callable[[str], bool]:
-    """Returns a function that checks if a string satisfies all the given predicates."""
-    return lambda s: all([p(s) for p in predicates])
+def _format_dates(raw: str) -> str:
+    """Formats a raw DD/MM or DD/MM-DD/MM date string for display."""
+    return ' - '.join(_format_day_month(_parse_ddmm(d)) for d in raw.split('-'))
 
 
-# returns a function that checks if a string is only composed of non special charaters
-def is_only_non_special_characters() -> Callable[[str], bool]:
-    """Returns a function that checks if a string is only composed of non special charaters."""
-    return lambda s: all([c.isalnum() or c.isspace() or c in ACCEPTED_CHARACTERS for c in s])
+def build_post(update: Update, context: CallbackContext) -> str:
+    """Builds the post to be sent to the channel"""
+    user_data = context.user_data
+    return POST_TEMPLATE.format(title=user_data[TITLE],
+                                emoji=user_data[EMOJI],
+                                date=_format_dates(user_data[DATE]),
+                                description=user_data[DESCRIPTION],
+                                link=user_data[LINK],
+                                contact=user_data[CONTACT])
 
 
 def is_shorter_than(length: int) -> Callable[[str], bool]:
@@ -101,60 +130,84 @@ def is_shorter_than(length: int) -> Callable[[str], bool]:
     return lambda s: len(s) < length
 
 
-def is_emoji() -> Callable[[str], bool]:
-    """Returns a function that checks if a string is an emoji."""
-    return lambda s: emoji.emoji_count(s) == 1 and len(s) == 1
+# Character class covering alphanumerics, whitespace and the accepted punctuation,
+# so the title scan is a single C-level match instead of a per-character loop
+_TITLE_RE = re.compile(r'\A[\w\s' + re.escape(''.join(ACCEPTED_CHARACTERS)) + r']*\Z')
+
+
+def _is_title(s: str) -> bool:
+    """Checks that a string fits the title limit and has no special characters."""
+    return len(s) < LIMITS[TITLE] and _TITLE_RE.match(s) is not None
+
 
+@functools.lru_cache(maxsize=512)
+def _parse_ddmm(text: str) -> datetime.date | None:
+    """Parses a DD/MM string into a date, or returns None if it is invalid."""
+    if len(text) != 5 or text[2] != '/':
+        return None
+    try:
+        return datetime.date(2000, int(text[3:5]), int(text[:2]))
+    except ValueError:
+        return None
 
-def _check_one_date(text: str) -> bool:
-    """Checks one date"""
-    if len(text) == 5 and text[2] == '/':
-        try:
-            datetime.datetime.strptime(text, '%d/%m')
-            return True
-        except ValueError:
-            return False
+
+def _is_date(s: str) -> bool:
+    """Checks if a string is a date or a date range."""
+    if len(s) == 5:
+        return _parse_ddmm(s) is not None
+    if len(s) == 11 and s[5] == '-':
+        start, end = _parse_ddmm(s[:5]), _parse_ddmm(s[6:])
+        return start is not None and end is not None and start < end
     return False
 
 
-def is_date() -> Callable[[str], bool]:
-    """Returns a function that checks if a string is a date."""
-    return lambda s: _check_one_date(s) if len(s) == 5 else (
-            len(s) == 11 and s[5] == '-' and _check_one_date(s[:5]) and _check_one_date(
-        s[6:]) and datetime.datetime.strptime(s[:5], '%d/%m') < datetime.datetime.strptime(s[6:], '%d/%m'))
+# Validation rules for each field, built once at import time so handlers do not
+# rebuild closures on every message
+VALIDATORS: dict[str, Callable[[str], bool]] = {
+    POST: lambda s: True,
+    TITLE: _is_title,
+    EMOJI: emoji.is_emoji,
+    DATE: _is_date,
+    DESCRIPTION: is_shorter_than(LIMITS[DESCRIPTION]),
+    LINK: is_shorter_than(LIMITS[LINK]),
+    CONTACT: is_shorter_than(LIMITS[CONTACT]),
+}
 
 
 def _get_question(field: str) -> str:
     """Returns the question to ask for a given field."""
     question = fields_and_questions[field]
-    if field in LIMITS.keys():
+    if field in LIMITS:
         question += f' (max {LIMITS[field]} characters)'
-    if field in SPECIFIC_FORMATTING_INSTRUCTIONS.keys():
+    if field in SPECIFIC_FORMATTING_INSTRUCTIONS:
         question += f' ({SPECIFIC_FORMATTING_INSTRUCTIONS[field]})'
     return question
 
 
-async def go_next(update: Update, context: CallbackContext, field: str, rule: Callable[[str], bool]) -> str:
+# Full question text per field, rendered once at import time
+QUESTIONS = {field: _get_question(field) for field in flow}
+
+
+async def go_next(update: Update, context: CallbackContext, field: str) -> str:
     """Stores the confirmation and ends the conversation."""
     user = update.message.from_user
     text = update.message.text
     logger.info("%s of %s: %s", field, user.first_name, text)
-    while not rule(text):
-        await update.message.reply_text(_get_question(field))
+    if not VALIDATORS[field](text):
+        await update.message.reply_text(QUESTIONS[field])
         return field
     context.user_data[field] = update.message.text
 
     # reply with question of next field
-    next_field = flow[flow.index(field) + 1]
+    next_field = NEXT_FIELD[field]
 
     if next_field == CONFIRMATION:
-        reply_keyboard = [[CONFIRM, DENY]]
-        text = await build_post(update, context)
+        text = build_post(update, context) + '\n' + QUESTIONS[CONFIRMATION]
         await update.message.reply_text(text,
-                                        reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True),
+                                        reply_markup=CONFIRM_KEYBOARD,
                                         parse_mode=ParseMode.HTML)
-
-    await update.message.reply_text(_get_question(next_field))
+    else:
+        await update.message.reply_text(QUESTIONS[next_field])
 
     return next_field
 
@@ -177,57 +230,30 @@ async def help_command(update: Update, context: CallbackContext) -> None:
 
 async def new_post(update: Update, context: CallbackContext) -> str:
     """Starts the conversation and asks the user about the post."""
-    await update.message.reply_text(fields_and_questions[POST])
-    return await go_next(update, context, POST, lambda s: True)
-
-
-async def title(update: Update, context: CallbackContext) -> str:
-    """Stores the title."""
-    rule = and_([is_only_non_special_characters(), is_shorter_than(LIMITS[TITLE])])
-    return await go_next(update, context, TITLE, rule)
-
-
-async def myemoji(update: Update, context: CallbackContext) -> str:
-    """Stores the emoji."""
-    return await go_next(update, context, EMOJI, is_emoji())
-
-
-async def date(update: Update, context: CallbackContext) -> str:
-    """Stores the date."""
-    return await go_next(update, context, DATE, is_date())
-
-
-async def description(update: Update, context: CallbackContext) -> str:
-    """Stores the description."""
-    return await go_next(update, context, DESCRIPTION, is_shorter_than(LIMITS[DESCRIPTION]))
-
-
-async def link(update: Update, context: CallbackContext) -> str:
-    """Stores the link."""
-    return await go_next(update, context, LINK, is_shorter_than(LIMITS[LINK]))
-
-
-async def contact(update: Update, context: CallbackContext) -> str:
-    """Stores the contact and asks for confirmation."""
-    return await go_next(update, context, CONTACT, is_shorter_than(LIMITS[CONTACT]))
+    first_field = flow[1]
+    await update.message.reply_text(fields_and_questions[POST] + '\n\n' + QUESTIONS[first_field])
+    return first_field
 
 
 async def confirmation(update: Update, context: CallbackContext) -> int:
     """Stores the confirmation and ends the conversation."""
-    user = update.message.from_user
-    logger.info("Confirmation of %s: %s", user.first_name, update.message.text)
+    query = update.callback_query
+    logger.info("Confirmation of %s: %s", query.from_user.first_name, query.data)
+
+    await query.answer()
+    await query.edit_message_reply_markup(None)
 
-    if update.message.text == CONFIRM:
-        await update.message.reply_text(CONFIRM_SENT, reply_markup=ReplyKeyboardRemove())
+    if query.data == CONFIRM:
+        await query.message.reply_text(CONFIRM_SENT)
 
         # Send the post to the channel
         await context.bot.send_message(
-            chat_id=os.getenv('MODERATION_CHAT_ID'),
-            text=await build_post(update, context),
+            chat_id=MODERATION_CHAT_ID,
+            text=build_post(update, context),
             parse_mode=ParseMode.HTML)
         return ConversationHandler.END
     else:
-        await update.message.reply_text(CANCEL_SENT, reply_markup=ReplyKeyboardRemove())
+        await query.message.reply_text(CANCEL_SENT)
         return ConversationHandler.END
 
 
@@ -235,7 +261,7 @@ async def cancel(update: Update, context: CallbackContext) -> int:
     """Cancels and ends the conversation."""
     user = update.message.from_user
     logger.info("User %s canceled the conversation.", user.first_name)
-    await update.message.reply_text(CANCEL_SENT, reply_markup=ReplyKeyboardRemove())
+    await update.message.reply_text(CANCEL_SENT, reply_markup=REMOVE_KEYBOARD)
 
     return ConversationHandler.END
 
@@ -244,21 +270,26 @@ def main() -> None:
     """Start the bot."""
     print("Going live!")
 
-    # Create application
-    application = Application.builder().token(TOKEN).build()
+    # Use the libuv event loop, which handles the I/O-bound handlers faster than asyncio's default
+    uvloop.install()
+
+    # Create application, with a pooled HTTP/2 client so concurrent sends multiplex over one TLS session
+    application = (Application.builder()
+                   .token(TOKEN)
+                   .concurrent_updates(True)
+                   .request(HTTPXRequest(connection_pool_size=256, http_version='2',
+                                         connect_timeout=5.0, read_timeout=20.0, pool_timeout=30.0))
+                   .get_updates_request(HTTPXRequest(http_version='2'))
+                   .build())
+
+    # Add conversation handler with one generic go_next state per form field
+    states = {field: [MessageHandler(TEXT_MESSAGE, functools.partial(go_next, field=field))]
+              for field in flow[1:-1]}
+    states[CONFIRMATION] = [CallbackQueryHandler(confirmation, pattern=f'^({CONFIRM}|{DENY})$')]
 
-    # Add conversation handler with the states POST, TITLE, DESCRIPTION, IMAGE, LINK, CONFIRMATION
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler('post', new_post)],
-        states={
-            TITLE: [MessageHandler(filters.TEXT & ~filters.COMMAND, title)],
-            EMOJI: [MessageHandler(filters.TEXT & ~filters.COMMAND, myemoji)],
-            DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, date)],
-            DESCRIPTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, description)],
-            LINK: [MessageHandler(filters.TEXT & ~filters.COMMAND, link)],
-            CONTACT: [MessageHandler(filters.TEXT & ~filters.COMMAND, contact)],
-            CONFIRMATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, confirmation)],
-        },
+        states=states,
         fallbacks=[CommandHandler('cancel', cancel)],
     )
 
@@ -270,13 +301,18 @@ def main() -> None:
 
     # Start the Bot
     print("Bot starting...")
-    if os.environ.get('ENV') == 'DEV':
-        application.run_polling()
-    elif os.environ.get('ENV') == 'PROD':
+    # Only subscribe to the update types the bot handles, so Telegram never
+    # delivers edited_message/channel_post/... events that would be parsed and dropped
+    allowed_updates = [Update.MESSAGE, Update.CALLBACK_QUERY]
+    if ENV == 'DEV':
+        application.run_polling(allowed_updates=allowed_updates)
+    elif ENV == 'PROD':
         application.run_webhook(listen="0.0.0.0",
                                 port=int(PORT),
                                 webhook_url=HEROKU_PATH,
-                                secret_token="passphrase")
+                                secret_token="passphrase",
+                                allowed_updates=allowed_updates,
+                                max_connections=100)
     return
 
 